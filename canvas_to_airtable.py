@@ -1,12 +1,25 @@
 import os
+import sys
+import json
 import time
+import random
+import functools
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import traceback
 import re
+import threading
 from typing import Dict, List, Tuple, Optional
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pyairtable import Api
 
+try:
+    import orjson  # faster parse of large Canvas pages; optional
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 # ==============================
 # Env / Config
 # ==============================
@@ -24,18 +37,43 @@ AIRTABLE_SUMMARY_TABLE  = os.environ.get("AIRTABLE_SUMMARY_TABLE",  "Phoenix Chr
 
 # Run-time toggles
 DEBUG = os.environ.get("DEBUG", "0") == "1"
-LOG_SCHEMA = os.environ.get("LOG_SCHEMA", "0") == "1"
+LOG_SCHEMA = os.environ.get("LOG_SCHEMA", "0") == "1"                  # also runs the single-select pre-check (report only)
 ALLOW_SELECT_FALLBACK = os.environ.get("ALLOW_SELECT_FALLBACK", "0") == "1"
-SLEEP_BETWEEN_REQUESTS = float(os.environ.get("SLEEP_BETWEEN_REQUESTS", "0.0"))
+SELECT_CHECK_STRICT = os.environ.get("SELECT_CHECK_STRICT", "0") == "1"  # abort on unknown single-select options
 SHOW_FETCH_ASSIGNMENTS = True
 SHOW_FETCH_SUBMISSIONS = True
 ENABLE_AIRTABLE_WRITE_PROBE = False
 
-# === HARD-CODED: wipe tables first by default ===
-WIPE_TABLES_FIRST = True
+# Canvas concurrency
+CANVAS_WORKERS = int(os.environ.get("CANVAS_WORKERS", "8"))            # students fetched in parallel
+COURSE_WORKERS = int(os.environ.get("COURSE_WORKERS", "4"))            # courses per student in parallel
+CANVAS_MAX_INFLIGHT = int(os.environ.get("CANVAS_MAX_INFLIGHT", "16"))  # cap on concurrent Canvas requests
+CANVAS_USE_GRAPHQL = os.environ.get("CANVAS_USE_GRAPHQL", "0") == "1"    # one POST per student, REST fallback
+CANVAS_RATE_LOW_WATER = float(os.environ.get("CANVAS_RATE_LOW_WATER", "100"))  # start pacing below this quota
+
+# On-disk cache for slow-changing Canvas lookups (re-runs after a schema failure etc.)
+CANVAS_CACHE_DIR = os.environ.get("CANVAS_CACHE_DIR", ".cache")
+CANVAS_CACHE_TTL = float(os.environ.get("CANVAS_CACHE_TTL", "0"))      # seconds; 0 (default) = no disk cache, always fetch live
+AIRTABLE_SCHEMA_CACHE_TTL = float(os.environ.get("AIRTABLE_SCHEMA_CACHE_TTL", "0"))  # seconds; 0 = always fetch live schema
+
+# === Wipe tables first by default; WIPE_TABLES_FIRST=0 replaces only this run's students' rows ===
+WIPE_TABLES_FIRST = os.environ.get("WIPE_TABLES_FIRST", "1") == "1"
+# "wipe" (default): delete everything, then create; also drops students who left the roster.
+# "upsert": merge on the key fields below, no wipe. FORCE_WIPE=1 forces wipe whatever the mode says.
+FORCE_WIPE = os.environ.get("FORCE_WIPE", "0") == "1"
+AIRTABLE_WRITE_MODE = "wipe" if FORCE_WIPE else os.environ.get("AIRTABLE_WRITE_MODE", "wipe").strip().lower()
+AIRTABLE_PRUNE_STALE = os.environ.get("AIRTABLE_PRUNE_STALE", "1") == "1"   # upsert mode: drop this run's students' rows not rewritten
+# Upsert keys use Canvas IDs only (student and assignment names can repeat); both tables need these fields for upsert mode
+DETAILED_KEY_FIELDS = ["Student ID", "Course ID", "Assignment ID"]
+SUMMARY_KEY_FIELDS  = ["Student ID", "Course ID"]
 FAST_WIPE_WORKERS = int(os.environ.get("FAST_WIPE_WORKERS", "8"))   # parallel delete threads
 FAST_WIPE_PAGE_SIZE = int(os.environ.get("FAST_WIPE_PAGE_SIZE", "100"))
-AIRTABLE_RPS = float(os.environ.get("AIRTABLE_RPS", "10"))          # crude throttle (requests/sec)
+FAST_WIPE_PASSES = int(os.environ.get("FAST_WIPE_PASSES", "5"))    # delete attempts per batch (first try + retries)
+AIRTABLE_WIPE_VIEW = os.environ.get("AIRTABLE_WIPE_VIEW", "").strip()  # optional unfiltered, fields-hidden view to list IDs from
+AIRTABLE_RPS = float(os.environ.get("AIRTABLE_RPS", "5"))           # token-bucket rate for all Airtable calls; Airtable allows 5 req/s per base
+AIRTABLE_WRITE_WORKERS = int(os.environ.get("AIRTABLE_WRITE_WORKERS", "5"))  # parallel create threads
+AIRTABLE_LOOKUP_WORKERS = int(os.environ.get("AIRTABLE_LOOKUP_WORKERS", "4"))  # parallel per-student filterByFormula lookups
+AIRTABLE_STUDENTS_PER_WRITE = int(os.environ.get("AIRTABLE_STUDENTS_PER_WRITE", "20"))  # students per streamed write group
 
 # Partition/job label from workflow (e.g., "B2C_P1" / "B2C_P2" / "Phoenix" ...)
 PARTNER_NAME = os.environ.get("PARTNER_NAME", "").strip()
@@ -49,8 +87,11 @@ if not STUDENT_USER_IDS_RAW and PARTNER_NAME.upper().endswith("_P1"):
 elif not STUDENT_USER_IDS_RAW and PARTNER_NAME.upper().endswith("_P2"):
     STUDENT_USER_IDS_RAW = os.environ.get("STUDENT_IDS_B2C_P2", "").strip()
 
-# Skip these assignment titles (exact match, lowercased elsewhere)
-SKIP_EXACT_TITLES = {"end of unit feedback", "quarterly feedback"}
+# Skip these assignment titles (exact match after strip + lowercase)
+SKIP_EXACT_TITLES = frozenset({"end of unit feedback", "quarterly feedback"})
+
+def _is_skipped_title(name: Optional[str]) -> bool:
+    return bool(name) and name.strip().lower() in SKIP_EXACT_TITLES
 
 # Exclude these courses (exact name or containing the word "Live")
 EXCLUDED_COURSE_EXACT = {"canvas student orientation program"}
@@ -94,98 +135,429 @@ tbl_summary,  summary_selector  = _resolve_table(AIRTABLE_BASE_ID, AIRTABLE_SUMM
 # ==============================
 # Canvas helpers (PAT + masquerade)
 # ==============================
+# All Canvas traffic goes to BASE_URL's host; one semaphore caps in-flight requests
+# across the student/course worker pools so we stay under the token's rate limit.
+_canvas_slots = threading.BoundedSemaphore(max(1, CANVAS_MAX_INFLIGHT))
+# Identical GETs issued concurrently (e.g. students sharing a course) share one
+# round-trip: the first caller fetches, the rest wait on its Future.
+_inflight: Dict[tuple, Future] = {}
+_inflight_lock = threading.Lock()
+# Leaf fetches (they never wait on other pool tasks) run here so a course's
+# assignment walk and submission walk overlap instead of running back to back.
+_canvas_leaf_pool = ThreadPoolExecutor(max_workers=max(1, CANVAS_MAX_INFLIGHT))
+
+# One pooled keep-alive session for every Canvas call; urllib3 retries 429/5xx
+# with jittered exponential backoff and honours Retry-After. Exhausted retries
+# return the last response so raise_for_status() below still surfaces the HTTPError.
+SESSION = requests.Session()
+SESSION.headers["Authorization"] = f"Bearer {CANVAS_ACCESS_TOKEN}"
+_canvas_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,  # spread retries from parallel workers apart
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("https://", _canvas_adapter)
+SESSION.mount("http://", _canvas_adapter)
+
+def _params_key(params) -> tuple:
+    if not params:
+        return ()
+    items = params.items() if isinstance(params, dict) else params
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in items))
+
+# Canvas reports the token's remaining throttle quota on every response
+# (X-Rate-Limit-Remaining, ~700 when idle). Requests only slow down once it
+# drains below CANVAS_RATE_LOW_WATER, scaled by how far below it is.
+_rate_remaining = 700.0
+
+def _pace_canvas():
+    remaining = _rate_remaining
+    if remaining < CANVAS_RATE_LOW_WATER:
+        time.sleep(0.5 * (CANVAS_RATE_LOW_WATER - max(0.0, remaining)) / CANVAS_RATE_LOW_WATER)
+
+def _note_rate_limit(resp):
+    global _rate_remaining
+    try:
+        _rate_remaining = float(resp.headers["X-Rate-Limit-Remaining"])
+    except (KeyError, ValueError):
+        pass
+
+def _is_canvas_throttled(resp) -> bool:
+    # Canvas signals an exhausted quota as 403 with this text, not 429
+    return resp.status_code == 403 and "Rate Limit Exceeded" in resp.text
+
+def _canvas_get(url: str, params=None):
+    attempts = 4
+    for attempt in range(attempts):
+        _pace_canvas()
+        with _canvas_slots:
+            resp = SESSION.get(url, params=params, timeout=60)
+        _note_rate_limit(resp)
+        if attempt < attempts - 1 and _is_canvas_throttled(resp):
+            delay = min(30.0, 2 * (2 ** attempt) * (1 + random.random() * 0.5))
+            p(f"[WARN] Canvas rate limit exceeded; retrying in {delay:.1f}s...")
+            time.sleep(delay)
+            continue
+        resp.raise_for_status()
+        return resp
+
 def make_canvas_request(endpoint: str, params=None):
-    if SLEEP_BETWEEN_REQUESTS:
-        time.sleep(SLEEP_BETWEEN_REQUESTS)
     url = endpoint if endpoint.startswith("http") else f"{BASE_URL}/{endpoint.lstrip('/')}"
-    headers = {"Authorization": f"Bearer {CANVAS_ACCESS_TOKEN}"}
-    resp = requests.get(url, headers=headers, params=params, timeout=60)
+    key = (url, _params_key(params))
+    with _inflight_lock:
+        fut = _inflight.get(key)
+        owner = fut is None
+        if owner:
+            fut = _inflight[key] = Future()
+    if not owner:
+        return fut.result()
+    try:
+        resp = _canvas_get(url, params)
+        fut.set_result(resp)
+        return resp
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+def _json(resp):
+    """Parse a response body straight from bytes (orjson when installed)."""
+    return _loads(resp.content)
+
+_NEXT_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+def _next_endpoint(resp) -> Optional[str]:
+    """Next page URL from the Link header, or None on the last page.
+    Absolute; make_canvas_request uses http(s) URLs as-is."""
+    m = _NEXT_LINK_RE.search(resp.headers.get("Link", ""))
+    return m.group(1) if m else None
+
+def _iter_pages(endpoint: str, params=None):
+    """Yield each page's JSON list, following Link: rel="next" as it goes."""
+    while endpoint:
+        resp = make_canvas_request(endpoint, params=params)
+        yield _json(resp)
+        endpoint = _next_endpoint(resp)
+        params = None
+
+def _canvas_graphql(query: str, variables: dict) -> dict:
+    # BASE_URL ends in /api/v1; GraphQL lives at /api/graphql on the same host
+    root = BASE_URL[:-len("/api/v1")] if BASE_URL.endswith("/api/v1") else BASE_URL
+    _pace_canvas()
+    with _canvas_slots:
+        resp = SESSION.post(f"{root}/api/graphql", json={"query": query, "variables": variables}, timeout=120)
+    _note_rate_limit(resp)
     resp.raise_for_status()
-    return resp
+    return _json(resp)
 
+def _cache_read(path: str, ttl: Optional[float] = None):
+    ttl = CANVAS_CACHE_TTL if ttl is None else ttl
+    if ttl <= 0:
+        return None
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _cache_write(path: str, data, ttl: Optional[float] = None) -> None:
+    if (CANVAS_CACHE_TTL if ttl is None else ttl) <= 0:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        dbg(f"cache write failed for {path}: {e}")
+
+def _cache_path(namespace: str, *args) -> str:
+    key = re.sub(r"[^\w.-]", "_", "-".join(str(a) for a in args))
+    return os.path.join(CANVAS_CACHE_DIR, namespace, f"{key}.json")
+
+def _disk_cached(namespace: str):
+    """
+    Cache a function's JSON-able result under CANVAS_CACHE_DIR/<namespace>/ for
+    CANVAS_CACHE_TTL seconds (0 disables), keyed by its positional args.
+    Failed calls raise before anything is written, so errors are never cached.
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args):
+            path = _cache_path(namespace, *args)
+            cached = _cache_read(path)
+            if cached is not None:
+                return cached
+            data = fn(*args)
+            _cache_write(path, data)
+            return data
+        return wrapper
+    return deco
+
+@functools.lru_cache(maxsize=1024)
+@_disk_cached("canvas_profiles")
 def get_user_profile_admin(user_id: str) -> dict:
-    return make_canvas_request("users/self/profile", params={"as_user_id": user_id}).json()
+    """Profile lookups are cached in-process and on disk."""
+    return _json(make_canvas_request("users/self/profile", params={"as_user_id": user_id}))
+
+def _walk_courses_for_state(user_id: str, enrollment_state: str) -> List[dict]:
+    params = {"as_user_id": user_id, "enrollment_state": enrollment_state, "per_page": 100, "include[]": "term"}
+    out: List[dict] = []
+    for data in _iter_pages("users/self/courses", params):
+        out.extend(data)
+    return out
 
-def get_all_active_courses_admin(user_id: str, term_id=None) -> List[dict]:
+def iter_active_courses_admin(user_id: str, term_id=None):
     """
     Request includes term; Canvas returns student-personalized course info.
     We'll prefer 'original_name' to avoid student nicknames being used.
+    Yields courses de-duplicated across enrollment states, as each state's walk finishes.
+    The full list is cached on disk per user (CANVAS_CACHE_TTL) once the walk completes.
     """
-    states = ["active", "invited_or_pending", "completed", "inactive"]
-    seen = set()
-    courses: List[dict] = []
-    for es in states:
-        endpoint = "users/self/courses"
-        params = {"as_user_id": user_id, "enrollment_state": es, "per_page": 100, "include[]": "term"}
-        while endpoint:
-            resp = make_canvas_request(endpoint, params=params)
-            data = resp.json()
-            if term_id is not None:
-                data = [c for c in data if c.get("enrollment_term_id") == term_id]
-            for c in data:
+    cache_path = _cache_path("canvas_courses", user_id)
+    courses = _cache_read(cache_path)
+    if courses is None:
+        courses = []
+        states = ["active", "invited_or_pending", "completed", "inactive"]
+        # the four walks are independent; run them side by side, merge in state order
+        walks = [_canvas_leaf_pool.submit(_walk_courses_for_state, user_id, es) for es in states]
+        seen = set()
+        for walk in walks:
+            for c in walk.result():
                 cid = c.get("id")
                 if cid and cid not in seen:
                     seen.add(cid)
                     courses.append(c)
-            # pagination
-            links = resp.headers.get("Link", "")
-            next_url = None
-            for link in links.split(","):
-                if 'rel="next"' in link:
-                    next_url = link[link.find("<")+1:link.find(">")]
-                    break
-            if next_url:
-                endpoint = next_url[len(BASE_URL)+1:] if next_url.startswith(BASE_URL) else next_url
-                params = None
-            else:
-                endpoint = None
-    return courses
-
-def get_all_assignments(course_id: int, stats: dict) -> List[dict]:
-    out = []
-    endpoint = f"courses/{course_id}/assignments"
-    while endpoint:
-        resp = make_canvas_request(endpoint)
-        data = resp.json()
+                    if term_id is None or c.get("enrollment_term_id") == term_id:
+                        yield c
+        _cache_write(cache_path, courses)
+        return
+    for c in courses:
+        if term_id is None or c.get("enrollment_term_id") == term_id:
+            yield c
+
+@functools.lru_cache(maxsize=512)
+def _course_assignments(course_id: int) -> Tuple[tuple, int]:
+    """Published, non-skipped assignments for a course plus the skipped count.
+    Cached per course: the list is the same for every student enrolled in it."""
+    kept, skipped = _fetch_course_assignments(course_id)
+    return tuple(kept), skipped
+
+@_disk_cached("canvas_assignments")
+def _fetch_course_assignments(course_id: int) -> list:
+    """[kept assignments, skipped count]; each kept assignment is trimmed to the
+    id/name/due_at the rows need, which keeps the disk cache small."""
+    out, skipped = [], 0
+    append, is_skipped = out.append, _is_skipped_title
+    for data in _iter_pages(f"courses/{course_id}/assignments"):
+        kept_lines = []
         for a in data:
             if not a.get("published"):
                 continue
-            name_norm = (a.get("name") or "").strip().lower()
-            if name_norm in SKIP_EXACT_TITLES:
-                stats["skipped"] += 1
+            if is_skipped(a.get("name")):
+                skipped += 1
                 continue
             if SHOW_FETCH_ASSIGNMENTS:
-                p(f"[KEEP] assignment {a.get('id')} '{a.get('name')}' course {course_id}")
-            out.append(a)
-            stats["processed"] += 1
-        links = resp.headers.get("Link", "")
-        next_url = None
-        for link in links.split(","):
-            if 'rel="next"' in link:
-                next_url = link[link.find("<")+1:link.find(">")]
-                break
-        endpoint = next_url[len(BASE_URL)+1:] if next_url else None
-    return out
+                kept_lines.append(f"[KEEP] assignment {a.get('id')} '{a.get('name')}' course {course_id}")
+            append({"id": a.get("id"), "name": a.get("name"), "due_at": a.get("due_at")})
+        if kept_lines:  # one write per page, not per assignment
+            p("\n".join(kept_lines))
+    return [out, skipped]
+
+def get_all_assignments(course_id: int, stats: dict) -> List[dict]:
+    kept, skipped = _course_assignments(course_id)
+    stats["processed"] += len(kept)
+    stats["skipped"] += skipped
+    return list(kept)
+
+_UNSUBMITTED = {"submission_status": "unsubmitted", "grade": "N/A"}  # shared; never mutated
+_DONE_STATUSES = frozenset({"graded", "excused"})        # our row statuses that count as completed
+_COMPLETED_STATES = frozenset({"graded", "submitted"})   # Canvas workflow_state values that can carry a grade
+_EMPTY_GRADES = frozenset({None, "-", ""})
+
+def _classify_submission(sub: dict) -> dict:
+    state = sub.get("workflow_state", "unsubmitted")
+    grade = sub.get("grade", "N/A")
+    if sub.get("excused", False):
+        return {"submission_status": "excused", "grade": "Excused"}
+    if state in _COMPLETED_STATES and grade not in _EMPTY_GRADES:
+        return {"submission_status": "graded", "grade": grade}
+    return _UNSUBMITTED
+
+def _student_id_value(user_id: str):
+    """Canvas user ID as a row value: an int like Course ID, unless it isn't numeric (e.g. sis_user_id:...)."""
+    return int(user_id) if str(user_id).isdigit() else str(user_id)
+
+def _course_rows(student_id, student_name: str, term_name: str, course_id: int, course_name: str, items) -> Tuple[List[dict], dict]:
+    """
+    Airtable-shaped detailed rows plus the course's summary row, in one pass.
+    `items` yields (assignment_id, assignment_name, due_date, {"submission_status", "grade"}).
+    """
+    detailed: List[dict] = []
+    append = detailed.append
+    completed = 0
+    for assignment_id, name, due, status in items:
+        sub_status = status.get("submission_status", "unsubmitted")
+        if sub_status in _DONE_STATUSES:
+            completed += 1
+        append({
+            "Student ID": student_id,
+            "Student Name": student_name,
+            "Term Name": term_name,
+            "Course Name": course_name,
+            "Course ID": course_id,
+            "Assignment ID": assignment_id,
+            "Assignment Name": name,
+            "Due Date": due or None,
+            "Submission Status": sub_status,
+            "Grade": status.get("grade", "N/A"),
+        })
+    total = len(detailed)
+    summary = {
+        "Student ID": student_id,
+        "Student Name": student_name,
+        "Term Name": term_name,
+        "Course Name": course_name,
+        "Course ID": course_id,
+        "Total Assignments": total,
+        "Completed": completed,
+        "Unsubmitted": total - completed,
+        "Percentage Completed": (completed / total) if total > 0 else 0.0,  # coerced to text if needed
+    }
+    return detailed, summary
 
 def get_submission(course_id: int, assignment_id: int, user_id: str) -> dict:
     try:
-        if SHOW_FETCH_SUBMISSIONS:
-            p(f"Fetching submission for assignment {assignment_id} (course {course_id}) user {user_id}")
-        sub = make_canvas_request(
+        dbg(f"Fetching submission for assignment {assignment_id} (course {course_id}) user {user_id}")
+        sub = _json(make_canvas_request(
             f"courses/{course_id}/assignments/{assignment_id}/submissions/{user_id}"
-        ).json()
-        state = sub.get("workflow_state", "unsubmitted")
-        grade = sub.get("grade", "N/A")
-        if sub.get("excused", False):
-            return {"submission_status": "excused", "grade": "Excused"}
-        if state in ["graded", "submitted"] and grade not in [None, "-", ""]:
-            return {"submission_status": "graded", "grade": grade}
-        return {"submission_status": "unsubmitted", "grade": "N/A"}
+        ))
+        return _classify_submission(sub)
     except requests.exceptions.HTTPError as e:
         if e.response is not None and e.response.status_code == 404:
-            return {"submission_status": "unsubmitted", "grade": "N/A"}
+            return _UNSUBMITTED
         raise
 
+def get_all_submissions(course_id: int, user_id: str) -> Dict[int, dict]:
+    """
+    One paginated call for all of a student's submissions in a course,
+    instead of one request per assignment. Returns {assignment_id: classified}.
+    """
+    if SHOW_FETCH_SUBMISSIONS:
+        p(f"Fetching submissions for course {course_id} user {user_id}")
+    out: Dict[int, dict] = {}
+    params = {"student_ids[]": user_id, "per_page": 100}
+    for data in _iter_pages(f"courses/{course_id}/students/submissions", params):
+        for sub in data:
+            aid = sub.get("assignment_id")
+            if aid is not None:
+                out[aid] = _classify_submission(sub)
+    return out
+
+_GQL_USER_BUNDLE = """
+query UserBundle($uid: ID!) {
+  legacyNode(_id: $uid, type: User) {
+    ... on User {
+      name
+      enrollments {
+        course {
+          _id
+          name
+          term { _id name }
+          assignmentsConnection {
+            pageInfo { hasNextPage }
+            nodes {
+              _id
+              name
+              dueAt
+              published
+              submissionsConnection(filter: {userId: $uid}) {
+                nodes { state grade excused }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+def fetch_user_enrollments_gql(user_id: str, stats: dict) -> Optional[Tuple[str, Dict[Tuple[str, str], Tuple[List[dict], dict]]]]:
+    """
+    Courses → assignments → submissions for one student in a single GraphQL POST.
+    Returns None (caller uses the REST path) on request/permission errors or
+    when an assignment list would need a second page.
+    """
+    try:
+        payload = _canvas_graphql(_GQL_USER_BUNDLE, {"uid": str(user_id)})
+    except requests.exceptions.RequestException as e:
+        p(f"[WARN] GraphQL fetch failed for user {user_id} ({e}); using REST")
+        return None
+    user = (payload.get("data") or {}).get("legacyNode")
+    if payload.get("errors") or not user:
+        p(f"[WARN] GraphQL returned errors for user {user_id}; using REST")
+        dbg(str(payload.get("errors"))[:500])
+        return None
+
+    student_name = user.get("name") or f"User {user_id}"
+    all_data: Dict[Tuple[str, str], Tuple[List[dict], dict]] = {}
+    seen = set()
+    processed = skipped = 0
+    for enrollment in user.get("enrollments") or []:
+        course = enrollment.get("course") or {}
+        cid = course.get("_id")
+        if not cid or cid in seen:
+            continue
+        seen.add(cid)
+        course_name = sys.intern(course.get("name") or f"Course {cid}")
+        if _is_excluded_course(course_name):
+            p(f"[SKIP COURSE] Excluding course '{course_name}' (id {cid})")
+            continue
+        conn = course.get("assignmentsConnection") or {}
+        if (conn.get("pageInfo") or {}).get("hasNextPage"):
+            p(f"[WARN] GraphQL assignments for course {cid} span several pages; using REST for user {user_id}")
+            return None
+        term = course.get("term") or {}
+        term_name = sys.intern(term.get("name") or (f"Term {term['_id']}" if term.get("_id") else "Unknown Term"))
+
+        items = []
+        for a in conn.get("nodes") or []:
+            if not a.get("published"):
+                continue
+            if _is_skipped_title(a.get("name")):
+                skipped += 1
+                continue
+            processed += 1
+            subs = (a.get("submissionsConnection") or {}).get("nodes") or []
+            if subs:
+                sub = subs[0]
+                status = _classify_submission({
+                    "workflow_state": sub.get("state"),
+                    "grade": sub.get("grade"),
+                    "excused": sub.get("excused"),
+                })
+            else:
+                status = _UNSUBMITTED
+            items.append((int(a["_id"]), a.get("name"), a.get("dueAt"), status))
+        all_data[(term_name, course_name)] = _course_rows(_student_id_value(user_id), student_name, term_name, int(cid), course_name, items)
+
+    stats["processed"] += processed
+    stats["skipped"] += skipped
+    return student_name, all_data
+
 # ==============================
 # Airtable helpers (retry + schema)
 # ==============================
@@ -202,19 +574,53 @@ def _status_from_exc(e):
         pass
     return None
 
-def _airtable_retry(fn, *args, **kwargs):
-    delays = [0, 1, 2, 4]
-    last_exc = None
-    for d in delays:
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is free at `rate` per second."""
+
+    def __init__(self, rate: float):
+        self.rate = max(0.1, float(rate))
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_airtable_bucket = TokenBucket(AIRTABLE_RPS)
+
+def _retry_after(e) -> Optional[float]:
+    try:
+        return float(e.response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+def _retry_airtable_call(call):
+    """Run `call` with retries on 429/5xx; `call` takes its own rate-limit tokens."""
+    attempts = 4
+    for attempt in range(attempts):
         try:
-            if d:
-                time.sleep(d)
-            return fn(*args, **kwargs)
+            return call()
         except Exception as e:
             status = _status_from_exc(e)
             if status in (429, 500, 502, 503, 504):
-                p(f"[WARN] Airtable API {status}; retrying in {d}s...")
-                last_exc = e
+                if attempt == attempts - 1:
+                    raise
+                # exponential with jitter so parallel workers don't retry in lockstep;
+                # the server's Retry-After wins when it asks for longer
+                delay = min(30.0, (2 ** attempt) * (1 + random.random() * 0.5))
+                delay = max(delay, _retry_after(e) or 0.0)
+                p(f"[WARN] Airtable API {status}; retrying in {delay:.1f}s...")
+                time.sleep(delay)
                 continue
             p("[ERROR] Airtable call failed (no retry):")
             try:
@@ -225,8 +631,22 @@ def _airtable_retry(fn, *args, **kwargs):
             except Exception:
                 pass
             raise
-    if last_exc:
-        raise last_exc
+
+def _airtable_retry(fn, *args, **kwargs):
+    def _paced_call():
+        _airtable_bucket.acquire()  # every attempt, retries included, waits for a token
+        return fn(*args, **kwargs)
+    return _retry_airtable_call(_paced_call)
+
+def _paced_pages(table, **kwargs):
+    """table.iterate(), taking a rate-limit token before each page request."""
+    pages = table.iterate(**kwargs)
+    while True:
+        _airtable_bucket.acquire()
+        page = next(pages, None)
+        if page is None:
+            return
+        yield page
 
 def _airtable_preflight():
     p(f"[INFO] Airtable target: base={AIRTABLE_BASE_ID} detailed={detailed_selector} summary={summary_selector}")
@@ -247,67 +667,83 @@ def _airtable_write_probe():
     except Exception:
         p("[WARN] Probe create succeeded but cleanup failed; continuing")
 
+@functools.lru_cache(maxsize=1)
 def _fetch_base_schema() -> Dict[str, dict]:
-    url = f"https://api.airtable.com/v0/meta/bases/{AIRTABLE_BASE_ID}/tables"
-    headers = {"Authorization": f"Bearer {AIRTABLE_API_KEY}"}
-    resp = requests.get(url, headers=headers, timeout=60)
-    resp.raise_for_status()
-    data = resp.json()
+    """Tables by id and by name. Optionally cached on disk (AIRTABLE_SCHEMA_CACHE_TTL)."""
+    cache_path = os.path.join(CANVAS_CACHE_DIR, "airtable_schema", f"{AIRTABLE_BASE_ID}.json")
+    data = _cache_read(cache_path, AIRTABLE_SCHEMA_CACHE_TTL)
+    if data is None:
+        data = _airtable_retry(_fetch_base_schema_live)
+        _cache_write(cache_path, data, AIRTABLE_SCHEMA_CACHE_TTL)
     out = {}
     for t in data.get("tables", []):
         out[t["id"]] = t
         out[t["name"]] = t
     return out
 
-def _single_select_options(table_def: dict):
-    opts = {}
+def _fetch_base_schema_live() -> dict:
+    # reuse pyairtable's pooled session (same host as the table calls)
+    url = api.build_url(f"meta/bases/{AIRTABLE_BASE_ID}/tables")
+    headers = {"Authorization": f"Bearer {AIRTABLE_API_KEY}"}
+    resp = api.session.get(url, headers=headers, timeout=60)
+    resp.raise_for_status()
+    return _json(resp)
+
+def _compile_table_def(table_def: dict) -> dict:
+    """One scan of a table's fields → {"writable", "options" (select choices), "types"} by field name."""
+    types: Dict[str, str] = {}
+    options: Dict[str, List[str]] = {}
     for f in table_def.get("fields", []):
+        name = f.get("name")
+        if not name:
+            continue
+        types[name] = f.get("type")
         if f.get("type") == "singleSelect":
-            choices = [c.get("name") for c in (f.get("options", {}).get("choices") or []) if c.get("name")]
-            opts[f["name"]] = choices
-    return opts
+            options[name] = [c.get("name") for c in (f.get("options", {}).get("choices") or []) if c.get("name")]
+    return {"writable": _writable_fieldnames(table_def), "options": options, "types": types}
 
-def _validate_or_coerce_selects(rows: List[dict], table_def: dict, table_label: str):
+def _validate_or_coerce_selects(rows: List[dict], table_info: dict, table_label: str):
     if not rows:
         return
-    options_map = _single_select_options(table_def)
+    options_map = table_info["options"]
     if LOG_SCHEMA:
         p(f"[SCHEMA] {table_label} select options: {{k: options_map[k][:10] for k in options_map}}")
     if not options_map:
         return
-    seen: Dict[str, set] = {fname: set() for fname in options_map.keys() if fname}
+    allowed = {fname: set(choices) for fname, choices in options_map.items() if fname}
+    unknown_by_field: Dict[str, set] = {fname: set() for fname in allowed}
     for r in rows:
-        for fname in options_map.keys():
-            if fname in r and r[fname] not in (None, ""):
-                seen[fname].add(r[fname])
-    missing: Dict[str, List[str]] = {}
-    for fname, values in seen.items():
-        allowed = set(options_map.get(fname, []))
-        unknown = [v for v in values if v not in allowed]
-        if unknown:
-            missing[fname] = sorted(set(unknown))
+        for fname, allowed_set in allowed.items():
+            v = r.get(fname)
+            if v and v not in allowed_set:
+                unknown_by_field[fname].add(v)
+    missing: Dict[str, List[str]] = {f: sorted(vals) for f, vals in unknown_by_field.items() if vals}
     if not missing:
         p(f"[INFO] {table_label}: single select values OK.")
         return
     if not ALLOW_SELECT_FALLBACK:
-        p(f"[FATAL] {table_label}: missing single-select options detected:")
+        level = "[FATAL]" if SELECT_CHECK_STRICT else "[WARN]"
+        p(f"{level} {table_label}: missing single-select options detected:")
         for fname, vals in missing.items():
             p(f"       - Field '{fname}': add options → {vals[:20]}{' ...' if len(vals)>20 else ''}")
         p("       Fix in Airtable (add these options or change field to 'Single line text'),")
         p("       or set ALLOW_SELECT_FALLBACK=1 to coerce unknowns to an existing option.")
-        raise SystemExit(1)
+        if SELECT_CHECK_STRICT:
+            raise SystemExit(1)
+        p("       Continuing: writes send typecast=true, so Airtable will add the options itself.")
+        return
     p(f"[WARN] {table_label}: coercing unknown single-select values (ALLOW_SELECT_FALLBACK=1).")
-    for fname, choices in options_map.items():
+    for fname, allowed_set in allowed.items():
+        choices = options_map[fname]
         if not choices:
             continue
-        fallback = "Other" if "Other" in choices else choices[0]
-        allowed = set(choices)
+        fallback = "Other" if "Other" in allowed_set else choices[0]
         for r in rows:
-            if fname in r and r[fname] not in allowed:
+            if fname in r and r[fname] not in allowed_set:
                 r[fname] = fallback
 
 # Writable-field filtering
-def _writable_fieldnames(table_def: dict) -> set:
+def _writable_fieldnames(table_def: dict) -> frozenset:
     non_writable = {"formula", "rollup", "lookup", "createdTime", "lastModifiedTime", "autoNumber", "button"}
     writable = set()
     for f in table_def.get("fields", []):
@@ -320,40 +756,32 @@ def _writable_fieldnames(table_def: dict) -> set:
         if ftype == "multipleRecordLinks":
             continue
         writable.add(name)
-    return writable
+    return frozenset(writable)
 
-def _filter_rows_to_writable(rows: List[dict], table_def: dict, label: str) -> List[dict]:
-    if not table_def or not rows:
+def _prepare_rows(rows: List[dict], table_info: dict, label: str, percent_field: Optional[str] = None) -> List[dict]:
+    """
+    One in-place pass over rows before writing: drop non-writable fields and,
+    when `percent_field` is single line text, format its 0..1 ratio as "xx.xx%".
+    """
+    if not table_info or not rows:
         return rows
-    writable = _writable_fieldnames(table_def)
-    trimmed = [{k: v for k, v in r.items() if k in writable} for r in rows]
-    try:
-        for orig, new in zip(rows, trimmed):
-            if orig.keys() != new.keys():
-                removed = [k for k in orig.keys() if k not in new]
-                p(f"[INFO] {label}: dropping non-writable fields → {removed}")
-                break
-    except Exception:
-        pass
-    return trimmed
-
-def _field_type(table_def: dict, field_name: str) -> Optional[str]:
-    for f in table_def.get("fields", []):
-        if f.get("name") == field_name:
-            return f.get("type")
-    return None
-
-def _coerce_percentage_for_schema(rows: List[dict], table_def: dict, field_name: str):
-    if not rows or not table_def:
-        return
-    ftype = _field_type(table_def, field_name)
-    if not ftype:
-        return
-    if ftype == "singleLineText":
-        for r in rows:
-            v = r.get(field_name, None)
+    writable = table_info["writable"]
+    # rows are all built with the same keys, so the first row tells us what to drop
+    removed = [k for k in rows[0] if k not in writable]
+    if removed:
+        p(f"[INFO] {label}: dropping non-writable fields → {removed}")
+    pct = percent_field if percent_field and table_info["types"].get(percent_field) == "singleLineText" else None
+    if not removed and not pct:
+        return rows
+    # rows are built fresh this run, so trim them in place rather than copying
+    for r in rows:
+        for k in removed:
+            r.pop(k, None)
+        if pct:
+            v = r.get(pct)
             if isinstance(v, (int, float)):
-                r[field_name] = f"{v*100:.2f}%"
+                r[pct] = f"{v*100:.2f}%"
+    return rows
 
 # ==============================
 # FAST WIPE HELPERS (always used)
@@ -361,126 +789,347 @@ def _coerce_percentage_for_schema(rows: List[dict], table_def: dict, field_name:
 def _delete_chunk(table, ids: List[str]):
     _airtable_retry(table.batch_delete, ids)
 
-def _collect_all_ids(table, label: str) -> List[str]:
-    """Robustly collect IDs. Try .all() first, then fall back to iterate()."""
-    ids: List[str] = []
-    sample: List[str] = []
-
-    # Primary: .all()
-    try:
-        records = _airtable_retry(table.all, page_size=FAST_WIPE_PAGE_SIZE)
-        for r in records or []:
-            rid = r.get("id")
-            if rid:
-                ids.append(rid)
-                if len(sample) < 3:
-                    sample.append(rid)
-    except Exception:
-        pass
-
-    # Fallback: iterate()
-    if not ids:
+def _iter_record_ids(table, formula: Optional[str] = None):
+    """
+    Stream record IDs page by page; only one small field is requested to keep pages light.
+    AIRTABLE_WIPE_VIEW must not filter records, or the wipe will miss the rows it hides.
+    """
+    kwargs = {"view": AIRTABLE_WIPE_VIEW} if AIRTABLE_WIPE_VIEW else {}
+    if formula:
+        kwargs["formula"] = formula
+    for page in _paced_pages(table, page_size=FAST_WIPE_PAGE_SIZE, fields=["Student Name"], **kwargs):
+        for rec in page:
+            yield rec["id"]
+
+def wipe_tables_fast(targets: List[Tuple[object, str]]):
+    """
+    Wipe several tables through one delete pool so both tables share the Airtable budget.
+    Each table's IDs are snapshotted first, limited to rows created before the wipe
+    started, and only that set is deleted: rows a concurrent partition (_P2 / SKIP_WIPE)
+    writes meanwhile are never touched. Failed batches are retried up to FAST_WIPE_PASSES.
+    """
+    max_workers = max(1, FAST_WIPE_WORKERS)
+    req_counts: Dict[str, int] = {label: 0 for _, label in targets}
+    totals: Dict[str, int] = {label: 0 for _, label in targets}
+    started = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    created_before = f'IS_BEFORE(CREATED_TIME(), DATETIME_PARSE("{started}"))'
+
+    pending: List[Tuple[object, str, List[str]]] = []
+    for table, label in targets:
+        p(f"[WIPE] Listing records from {label}…")
         try:
-            for page in table.iterate(page_size=FAST_WIPE_PAGE_SIZE):
-                if isinstance(page, dict):
-                    rid = page.get("id")
-                    if rid:
-                        ids.append(rid)
-                        if len(sample) < 3:
-                            sample.append(rid)
-                else:
-                    for rec in page:
-                        rid = rec.get("id") if isinstance(rec, dict) else None
-                        if rid:
-                            ids.append(rid)
-                            if len(sample) < 3:
-                                sample.append(rid)
+            ids = list(_iter_record_ids(table, created_before))
         except Exception:
-            p(f"[WARN] {label}: iterate() failed to list records")
+            p(f"[WARN] {label}: listing records failed")
             traceback.print_exc()
-
-    if ids:
-        p(f"[WIPE] {label}: found {len(ids)} record IDs (sample {sample})")
-    else:
-        p(f"[WIPE] {label}: no records returned by API. (Check table name/ID & token access.)")
-    return ids
-
-def wipe_table_fast(table, label: str):
-    p(f"[WIPE] Collecting all record IDs from {label}…")
-    ids = _collect_all_ids(table, label)
-    total = len(ids)
-    if not total:
-        p(f"[WIPE] {label}: nothing to delete.")
-        return
-    p(f"[WIPE] {label}: deleting {total} records in parallel…")
-
-    chunks: List[List[str]] = list(_chunks(ids, 10))  # 10 IDs per request
-    max_workers = max(1, FAST_WIPE_WORKERS)
-    per_second = max(1, int(AIRTABLE_RPS))
-    submitted = 0
-    done_reqs = 0
+            continue
+        if ids:
+            p(f"[WIPE] {label}: deleting {len(ids)} records")
+            pending.extend((table, label, ch) for ch in _chunks(ids, 10))  # 10 IDs per request
+        else:
+            p(f"[WIPE] {label}: nothing to delete.")
 
     with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futures = []
-        for ch in chunks:
-            futures.append(ex.submit(_delete_chunk, table, ch))
-            submitted += 1
-            if submitted % per_second == 0:
-                time.sleep(1.0)  # crude throttle
-
+        for pass_no in range(1, max(1, FAST_WIPE_PASSES) + 1):
+            if not pending:
+                break
+            if pass_no > 1:
+                p(f"[WIPE] Retrying {len(pending)} failed delete batches (pass {pass_no})…")
+            futures = {ex.submit(_delete_chunk, table, ch): (table, label, ch) for table, label, ch in pending}
+            pending = []
+            for fut in as_completed(futures):
+                table, label, ch = futures[fut]
+                try:
+                    fut.result()
+                    req_counts[label] += 1
+                    totals[label] += len(ch)
+                    if req_counts[label] % 50 == 0:
+                        dbg(f"[WIPE] {label}: ~{totals[label]} rows deleted (requests: {req_counts[label]})")
+                except Exception:
+                    p(f"[WARN] {label}: a delete batch failed; continuing")
+                    traceback.print_exc()
+                    pending.append((table, label, ch))
+
+    for _, label in targets:
+        if req_counts[label]:
+            p(f"[WIPE] {label}: wipe complete (requests: {req_counts[label]}, rows≈{totals[label]}).")
+    for _, label, ch in pending:
+        p(f"[WARN] {label}: {len(ch)} records could not be deleted: {_preview_ids(ch)}")
+
+def _formula_str(value: str) -> str:
+    """Airtable formula string literal (backslashes and double quotes escaped)."""
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def _parallel_batch_delete(table, ids: List[str]) -> int:
+    """Delete `ids` 10 per request on FAST_WIPE_WORKERS threads (shared Airtable rate limit); re-raises the first failure."""
+    if not ids:
+        return 0
+    deleted = 0
+    with ThreadPoolExecutor(max_workers=max(1, FAST_WIPE_WORKERS)) as ex:
+        futures = {ex.submit(_delete_chunk, table, ch): len(ch) for ch in _chunks(ids, 10)}
         for fut in as_completed(futures):
-            try:
-                fut.result()
-                done_reqs += 1
-                if done_reqs % 50 == 0:
-                    dbg(f"[WIPE] {label}: ~{done_reqs*10} rows deleted (requests: {done_reqs})")
-            except Exception:
-                p(f"[WARN] {label}: a delete batch failed; continuing")
-                traceback.print_exc()
+            fut.result()
+            deleted += futures[fut]
+    return deleted
 
-    p(f"[WIPE] {label}: wipe complete (requests: {len(chunks)}, rows≈{total}).")
+def _records_for_students(table, key_field: str, values: list, fields: List[str]) -> List[dict]:
+    """
+    All rows whose `key_field` ("Student ID" or "Student Name") is one of `values`.
+    Values go 20 per OR() formula so no single filter grows with the cohort; the
+    lookups run in parallel.
+    """
+    def _records_for(chunk: list) -> List[dict]:
+        # &"" compares as text, so a number or a text Student ID field both match
+        formula = "OR(" + ",".join(f'{{{key_field}}}&"" = {_formula_str(str(v))}' for v in chunk) + ")"
+        # one token per page: a lookup can span several pages for a large group of students
+        return _retry_airtable_call(
+            lambda: [r for page in _paced_pages(table, formula=formula, fields=fields) for r in page])
+
+    with ThreadPoolExecutor(max_workers=max(1, AIRTABLE_LOOKUP_WORKERS)) as ex:
+        return [r for recs in ex.map(_records_for, _chunks(values, 20)) for r in recs]
+
+def delete_existing_for_students(table, key_field: str, values: list, label: str):
+    """Delete just the rows belonging to this run's students, through one parallel delete."""
+    if not values:
+        return
+    ids = [r["id"] for r in _records_for_students(table, key_field, values, [key_field])]
+    total = _parallel_batch_delete(table, ids)
+    p(f"[DELETE] {label}: {total} existing rows for {len(values)} students")
+
+def prune_stale_for_students(table, student_ids: list, rows: List[dict], key_fields: List[str], label: str):
+    """
+    After an upsert: delete this run's students' rows whose key wasn't written
+    this run (assignment unpublished/renamed, course dropped). Other students'
+    rows are never touched.
+    """
+    if not student_ids:
+        return
+    # compare as text: an ID lands as int in a number field but as str in a text field
+    keep = {tuple(str(r.get(k, "")) for k in key_fields) for r in rows}
+    ids = [rec["id"] for rec in _records_for_students(table, "Student ID", student_ids, key_fields)
+           if tuple(str(rec["fields"].get(k, "")) for k in key_fields) not in keep]
+    total = _parallel_batch_delete(table, ids)
+    if total:
+        p(f"[DELETE] {label}: pruned {total} stale rows for {len(student_ids)} students")
 
 # ==============================
 # CRUD helpers (writes)
 # ==============================
-def airtable_insert_detailed(rows: List[dict]):
-    p(f"[INFO] Inserting {len(rows)} detailed rows")
-    if not rows:
-        return
-    for i, chunk in enumerate(_chunks(rows, 10), start=1):
-        try:
-            _airtable_retry(tbl_detailed.batch_create, chunk)
-            dbg(f" detailed batch {i} ok ({len(chunk)})")
-        except Exception:
-            p(f"[ERROR] detailed batch {i} failed, first record preview:")
-            try: p(str(chunk[0]))
-            except Exception: pass
-            traceback.print_exc()
-            raise
+def _create_chunk(table, chunk: List[dict]):
+    _airtable_retry(table.batch_create, chunk, typecast=True)
 
-def airtable_insert_summary(rows: List[dict]):
-    p(f"[INFO] Inserting {len(rows)} summary rows")
-    if not rows:
+def _upsert_chunk(table, chunk: List[dict], key_fields: List[str]):
+    _airtable_retry(table.batch_upsert, [{"fields": r} for r in chunk], key_fields=key_fields, typecast=True)
+
+def _run_write_batches(tasks: List[tuple]):
+    """Run (fn, args, kind, batch_no, chunk) tasks on the write pool; stop and re-raise on the first failure."""
+    if not tasks:
         return
-    for i, chunk in enumerate(_chunks(rows, 10), start=1):
-        try:
-            _airtable_retry(tbl_summary.batch_create, chunk)
-            dbg(f" summary batch {i} ok ({len(chunk)})")
-        except Exception:
-            p(f"[ERROR] summary batch {i} failed, first record preview:")
-            try: p(str(chunk[0]))
-            except Exception: pass
-            traceback.print_exc()
-            raise
+    first_exc = None
+    with ThreadPoolExecutor(max_workers=max(1, AIRTABLE_WRITE_WORKERS)) as ex:
+        futures = {ex.submit(fn, *args): (kind, i, ch) for fn, args, kind, i, ch in tasks}
+        for fut in as_completed(futures):
+            if fut.cancelled():  # queued behind the first failure; nothing to report
+                continue
+            kind, i, chunk = futures[fut]
+            try:
+                fut.result()
+                dbg(f" {kind} batch {i} ok ({len(chunk)})")
+            except Exception as e:
+                p(f"[ERROR] {kind} batch {i} failed, first record preview:")
+                try: p(str(chunk[0]))
+                except Exception: pass
+                traceback.print_exception(e)
+                if first_exc is None:
+                    first_exc = e
+                    for other in futures:
+                        other.cancel()  # stop queued batches, as the serial loop did
+    if first_exc is not None:
+        raise first_exc
+
+def airtable_insert_all(detailed_rows: List[dict], summary_rows: List[dict]):
+    """Create both tables' rows concurrently (10 per request) under the shared Airtable rate limit."""
+    p(f"[INFO] Inserting {len(detailed_rows)} detailed rows")
+    p(f"[INFO] Inserting {len(summary_rows)} summary rows")
+    tasks = [(_create_chunk, (tbl_detailed, ch), "detailed", i, ch) for i, ch in enumerate(_chunks(detailed_rows, 10), start=1)]
+    tasks += [(_create_chunk, (tbl_summary, ch), "summary", i, ch) for i, ch in enumerate(_chunks(summary_rows, 10), start=1)]
+    _run_write_batches(tasks)
+
+def _check_unique_keys(rows: List[dict], key_fields: List[str], label: str):
+    """Rows sharing an upsert key are distinct data; stop rather than let Airtable merge them."""
+    seen = set()
+    dupes = []
+    for r in rows:
+        key = tuple(r.get(k) for k in key_fields)
+        if key in seen:
+            dupes.append(key)
+        seen.add(key)
+    if dupes:
+        p(f"[FATAL] {label}: {len(dupes)} rows share an upsert key {key_fields}, e.g. {dupes[:3]}")
+        raise SystemExit(1)
+
+def _check_upsert_key_fields(detailed_info: Optional[dict], summary_info: Optional[dict]):
+    """Upsert needs every key field to exist (and be writable) in both tables."""
+    ok = True
+    for info, keys, label in ((detailed_info, DETAILED_KEY_FIELDS, "Detailed table"),
+                              (summary_info, SUMMARY_KEY_FIELDS, "Summary table")):
+        missing = keys if not info else [k for k in keys if k not in info["writable"]]
+        if missing:
+            p(f"[FATAL] {label}: upsert mode needs these fields → {missing}")
+            ok = False
+    if not ok:
+        p("       Add them in Airtable (number or single line text), or use AIRTABLE_WRITE_MODE=wipe.")
+        raise SystemExit(1)
+
+def airtable_upsert_all(detailed_rows: List[dict], summary_rows: List[dict]):
+    """Update-or-create both tables' rows on their key fields, so no wipe is needed beforehand."""
+    _check_unique_keys(detailed_rows, DETAILED_KEY_FIELDS, "Detailed table")
+    _check_unique_keys(summary_rows, SUMMARY_KEY_FIELDS, "Summary table")
+    p(f"[INFO] Upserting {len(detailed_rows)} detailed rows")
+    p(f"[INFO] Upserting {len(summary_rows)} summary rows")
+    tasks = [(_upsert_chunk, (tbl_detailed, ch, DETAILED_KEY_FIELDS), "detailed", i, ch)
+             for i, ch in enumerate(_chunks(detailed_rows, 10), start=1)]
+    tasks += [(_upsert_chunk, (tbl_summary, ch, SUMMARY_KEY_FIELDS), "summary", i, ch)
+              for i, ch in enumerate(_chunks(summary_rows, 10), start=1)]
+    _run_write_batches(tasks)
 
 # ==============================
 # Main
 # ==============================
+_ID_SEP_RE = re.compile(r"[,\s]+")
+
 def _parse_student_ids_from_env(raw: str) -> List[str]:
-    if not raw:
-        return []
-    parts = [x.strip() for chunk in raw.replace("\n", ",").replace(" ", ",").split(",") for x in [chunk] if x.strip()]
-    return parts
+    """IDs separated by commas and/or any whitespace (spaces, tabs, newlines)."""
+    return [x for x in _ID_SEP_RE.split(raw or "") if x]
+
+def _new_stats() -> Dict[str, int]:
+    return {"processed": 0, "skipped": 0}
+
+def _merge_stats(into: Dict[str, int], other: Dict[str, int]):
+    for k, v in other.items():
+        into[k] += v
+
+def _student_name(user_id: str) -> str:
+    return get_user_profile_admin(user_id).get("name", f"User {user_id}")
+
+def _process_course(course: dict, user_id: str, name_future: Future) -> Optional[Tuple[Tuple[str, str], List[dict], dict, Dict[str, int]]]:
+    cid = course["id"]
+
+    # Prefer official course name; fall back to student's nickname only if needed
+    course_name = sys.intern(course.get("original_name") or course.get("name") or f"Course {cid}")
+
+    # Exclude configured courses
+    if _is_excluded_course(course_name):
+        p(f"[SKIP COURSE] Excluding course '{course_name}' (id {cid})")
+        return None
+
+    term_obj = course.get("term") or {}
+    term_id = course.get("enrollment_term_id")
+    # interned: every row and the (term, course) keys share one string object
+    term_name = sys.intern(term_obj.get("name") or (f"Term {term_id}" if term_id else "Unknown Term"))
+
+    stats = _new_stats()  # per-task counters; merged by the caller, so no lock
+    subs_future = _canvas_leaf_pool.submit(get_all_submissions, cid, user_id)
+    assignments = get_all_assignments(cid, stats)
+    try:
+        submissions = subs_future.result()
+    except requests.exceptions.HTTPError as e:
+        status = _status_from_exc(e)
+        # a throttled 403 that outlived _canvas_get's retries would only get worse per assignment
+        if status not in (400, 403, 404) or (e.response is not None and _is_canvas_throttled(e.response)):
+            raise
+        p(f"[WARN] Bulk submissions unavailable for course {cid} ({status}); fetching per assignment")
+        subs = _canvas_leaf_pool.map(lambda a: get_submission(cid, a["id"], user_id), assignments)
+        submissions = {a["id"]: sub for a, sub in zip(assignments, subs)}
+    detailed, summary = _course_rows(
+        _student_id_value(user_id), name_future.result(), term_name, cid, course_name,
+        ((a["id"], a["name"], a.get("due_at"), submissions.get(a["id"], _UNSUBMITTED)) for a in assignments),
+    )
+    return (term_name, course_name), detailed, summary, stats
+
+def process_user(user_id: str) -> Tuple[str, Dict[Tuple[str, str], Tuple[List[dict], dict]], Dict[str, int]]:
+    """Fetch one student's courses/assignments/submissions; courses run in parallel.
+    Returns (student_name, (detailed rows, summary row) by (term, course), this student's stats)."""
+    stats = _new_stats()
+    if CANVAS_USE_GRAPHQL:
+        bundle = fetch_user_enrollments_gql(user_id, stats)
+        if bundle is not None:
+            return bundle + (stats,)
+
+    # the name lookup doesn't gate the course walk; run them side by side
+    name_future = _canvas_leaf_pool.submit(_student_name, user_id)
+
+    all_data: Dict[Tuple[str, str], Tuple[List[dict], dict]] = {}
+    with ThreadPoolExecutor(max_workers=max(1, COURSE_WORKERS)) as ex:
+        # courses start processing as soon as their page arrives
+        futures = [ex.submit(_process_course, c, user_id, name_future)
+                   for c in iter_active_courses_admin(user_id, term_id=None)]
+        for fut in futures:  # keep Canvas course order in the output
+            res = fut.result()
+            if res:
+                key, detailed, summary, course_stats = res
+                all_data[key] = (detailed, summary)
+                _merge_stats(stats, course_stats)
+    return name_future.result(), all_data, stats
+
+def _load_table_infos() -> Tuple[Optional[dict], Optional[dict]]:
+    """Compiled field info for the detailed and summary tables (None when a table isn't in the schema)."""
+    schema = _fetch_base_schema()
+    detailed_def = schema.get(AIRTABLE_DETAILED_TABLE_ID or AIRTABLE_DETAILED_TABLE)
+    summary_def  = schema.get(AIRTABLE_SUMMARY_TABLE_ID  or AIRTABLE_SUMMARY_TABLE)
+    return (_compile_table_def(detailed_def) if detailed_def else None,
+            _compile_table_def(summary_def)  if summary_def  else None)
+
+def _write_students(students: Dict[str, Tuple[str, Dict[Tuple[str, str], Tuple[List[dict], dict]]]],
+                    infos_future: Future, previous: Optional[Future]):
+    """Check, trim and write one group of students' rows (wipe or upsert mode); `students` is keyed by Canvas user ID."""
+    if previous is not None:
+        previous.result()  # a failed earlier group stops the rest, as a failed batch does
+
+    # Rows arrive Airtable-shaped from the course tasks; just concatenate
+    detailed_rows: List[dict] = []
+    summary_rows: List[dict] = []
+    for _, all_data in students.values():
+        for detailed, summary in all_data.values():
+            detailed_rows.extend(detailed)
+            summary_rows.append(summary)
+    student_ids = [_student_id_value(u) for u in students]
+    p(f"[INFO] Built {len(detailed_rows)} detailed rows; {len(summary_rows)} summary rows for {len(student_ids)} students.")
+
+    detailed_info, summary_info = infos_future.result()  # compiled once for the whole run
+    # Writes send typecast=true, so Airtable matches/creates select options itself.
+    # The client-side pass is a dry-run diagnostic (LOG_SCHEMA=1), an explicit coercion
+    # request (ALLOW_SELECT_FALLBACK=1) or an explicit gate (SELECT_CHECK_STRICT=1).
+    if LOG_SCHEMA or ALLOW_SELECT_FALLBACK or SELECT_CHECK_STRICT:
+        if detailed_info:
+            _validate_or_coerce_selects(detailed_rows, detailed_info, "Detailed table")
+        if summary_info:
+            _validate_or_coerce_selects(summary_rows, summary_info, "Summary table")
+        p("[STEP] Schema check finished.")
+
+    # Drop non-writable fields; if "Percentage Completed" is single line text, format as "xx.xx%"
+    if detailed_info:
+        detailed_rows = _prepare_rows(detailed_rows, detailed_info, "Detailed table")
+    if summary_info:
+        summary_rows  = _prepare_rows(summary_rows,  summary_info,  "Summary table", percent_field="Percentage Completed")
+
+    if AIRTABLE_WRITE_MODE == "wipe" and not WIPE_TABLES_FIRST:
+        # match on Student ID where the table has it; older bases only have the name
+        for table, info, label in ((tbl_detailed, detailed_info, "Detailed table"),
+                                   (tbl_summary,  summary_info,  "Summary table")):
+            if info and "Student ID" in info["writable"]:
+                delete_existing_for_students(table, "Student ID", student_ids, label)
+            else:
+                delete_existing_for_students(table, "Student Name", sorted({n for n, _ in students.values()}), label)
+
+    p("[STEP] Writing detailed + summary rows…")
+    if AIRTABLE_WRITE_MODE == "upsert":
+        airtable_upsert_all(detailed_rows, summary_rows)
+        if AIRTABLE_PRUNE_STALE:
+            prune_stale_for_students(tbl_detailed, student_ids, detailed_rows, DETAILED_KEY_FIELDS, "Detailed table")
+            prune_stale_for_students(tbl_summary,  student_ids, summary_rows,  SUMMARY_KEY_FIELDS,  "Summary table")
+    else:
+        airtable_insert_all(detailed_rows, summary_rows)
 
 def main():
     p("=== START canvas_to_airtable ===")
@@ -498,130 +1147,90 @@ def main():
         p("[INFO] No STUDENT_USER_IDS provided; nothing to do.")
         return
 
-    # ALWAYS WIPE FIRST (hard-coded) unless explicitly told to skip (for parallel partitions)
+    if AIRTABLE_WRITE_MODE not in ("wipe", "upsert"):
+        p(f"[FATAL] Unknown AIRTABLE_WRITE_MODE='{AIRTABLE_WRITE_MODE}' (expected 'wipe' or 'upsert').")
+        raise SystemExit(1)
+
+    # The base schema doesn't depend on Canvas; fetch it while the wipe + ingest run
+    schema_pool = ThreadPoolExecutor(max_workers=1)
+    infos_future = schema_pool.submit(_load_table_infos)
+    schema_pool.shutdown(wait=False)
+    if AIRTABLE_WRITE_MODE == "upsert":
+        _check_upsert_key_fields(*infos_future.result())  # fail before any Canvas work
+
+    # Wipe mode only: wipe first unless explicitly told to skip (for parallel partitions)
     SKIP_WIPE = os.environ.get("SKIP_WIPE", "0") == "1"
-    if PARTNER_NAME.upper().endswith("_P2") or SKIP_WIPE:
+    if AIRTABLE_WRITE_MODE == "upsert":
+        p("[WIPE] Skipped (upsert mode merges on key fields; FORCE_WIPE=1 to wipe).")
+    elif not WIPE_TABLES_FIRST:
+        p("[WIPE] Skipped (WIPE_TABLES_FIRST=0); this run's students' rows are replaced before writing.")
+    elif PARTNER_NAME.upper().endswith("_P2") or SKIP_WIPE:
         p("[WIPE] Skipped (either _P2 partition or SKIP_WIPE=1).")
     else:
-        p("[WIPE] Wiping both Airtable tables before writing (hard-coded).")
-        wipe_table_fast(tbl_detailed, "Detailed table")
-        wipe_table_fast(tbl_summary,  "Summary table")
+        p("[WIPE] Wiping both Airtable tables before writing.")
+        wipe_tables_fast([(tbl_detailed, "Detailed table"), (tbl_summary, "Summary table")])
 
-    stats = {"processed": 0, "skipped": 0}
+    stats = _new_stats()
     p("[INFO] Skipping global terms lookup; using course.term.name from Canvas.")
 
-    students_data = {}
+    # Students are written in input order, AIRTABLE_STUDENTS_PER_WRITE at a time, on a
+    # single writer thread while Canvas fetches for later students keep running.
+    user_ids = list(dict.fromkeys(user_ids))  # a repeated ID would stall the in-order release
+    writer = ThreadPoolExecutor(max_workers=1)
+    last_write: Optional[Future] = None
+    group: Dict[str, Tuple[str, Dict[Tuple[str, str], Tuple[List[dict], dict]]]] = {}  # by user ID
+    finished: Dict[str, Optional[Tuple[str, dict]]] = {}
+    next_idx = 0
+    students_written: List[str] = []
+
+    def _flush():
+        nonlocal last_write
+        if group:
+            last_write = writer.submit(_write_students, dict(group), infos_future, last_write)
+            students_written.extend(name for name, _ in group.values())
+            group.clear()
 
-    for user_id in user_ids:
-        try:
-            profile = get_user_profile_admin(user_id)
-            student_name = profile.get("name", f"User {user_id}")
-
-            courses = get_all_active_courses_admin(user_id, term_id=None)
-            seen_courses = set()
-            all_data: Dict[Tuple[str, str], List[dict]] = {}
-
-            for course in courses:
-                cid = course["id"]
-                if cid in seen_courses:
-                    continue
-                seen_courses.add(cid)
-
-                # Prefer official course name; fall back to student's nickname only if needed
-                course_name = course.get("original_name") or course.get("name") or f"Course {cid}"
-
-                # Exclude configured courses
-                if _is_excluded_course(course_name):
-                    p(f"[SKIP COURSE] Excluding course '{course_name}' (id {cid})")
-                    continue
-
-                term_obj = course.get("term") or {}
-                term_id = course.get("enrollment_term_id")
-                term_name = term_obj.get("name") or (f"Term {term_id}" if term_id else "Unknown Term")
-
-                assignments = get_all_assignments(cid, stats)
-                all_data[(term_name, course_name)] = [
-                    {
-                        "assignment_name": a["name"],
-                        "due_date": a.get("due_at"),
-                        "Course Name": course_name,
-                        "Term Name": term_name,
-                        **get_submission(cid, a["id"], user_id),
-                    }
-                    for a in assignments
-                ]
-
-            students_data[student_name] = {"detailed_data": all_data}
-        except requests.exceptions.HTTPError as e:
-            status = e.response.status_code if e.response is not None else "?"
-            p(f"[ERROR] User {user_id} failed with HTTP {status}. Ensure admin PAT with Masquerade.")
-            continue
-        except Exception as e:
-            p(f"[ERROR] Processing user {user_id}: {e}")
-            traceback.print_exc()
-            continue
-
-    # Flatten → Airtable rows
-    detailed_rows: List[dict] = []
-    summary_rows: List[dict] = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, CANVAS_WORKERS)) as ex:
+            futures = {ex.submit(process_user, u): u for u in user_ids}
+            for fut in as_completed(futures):
+                user_id = futures[fut]
+                finished[user_id] = None
+                try:
+                    student_name, all_data, user_stats = fut.result()
+                    finished[user_id] = (student_name, all_data)
+                    _merge_stats(stats, user_stats)
+                except requests.exceptions.HTTPError as e:
+                    status = e.response.status_code if e.response is not None else "?"
+                    p(f"[ERROR] User {user_id} failed with HTTP {status}. Ensure admin PAT with Masquerade.")
+                except Exception as e:
+                    p(f"[ERROR] Processing user {user_id}: {e}")
+                    traceback.print_exception(e)
+
+                # A failed write stops the run; don't keep fetching students nobody will write
+                if last_write is not None and last_write.done() and last_write.exception() is not None:
+                    p("[ERROR] An Airtable write failed; cancelling the remaining student fetches.")
+                    for other in futures:
+                        other.cancel()
+                    break
 
-    for student_name, data in students_data.items():
-        for (term_name, course_name), assignments in data["detailed_data"].items():
-            total = len(assignments)
-            completed = sum(1 for a in assignments if a.get("submission_status") in ["graded", "excused"])
-            unsubmitted = total - completed
-            pct = (completed / total) if total > 0 else 0.0
-
-            for a in assignments:
-                detailed_rows.append({
-                    "Student Name": student_name,
-                    "Term Name": term_name,
-                    "Course Name": course_name,
-                    "Assignment Name": a.get("assignment_name", "N/A"),
-                    "Due Date": a.get("due_date") or None,
-                    "Submission Status": a.get("submission_status", "unsubmitted"),
-                    "Grade": a.get("grade", "N/A"),
-                })
+                # Release students in input order so row order doesn't depend on thread timing
+                while next_idx < len(user_ids) and user_ids[next_idx] in finished:
+                    uid = user_ids[next_idx]
+                    res = finished.pop(uid)
+                    next_idx += 1
+                    if res:
+                        group[uid] = res
+                        if len(group) >= max(1, AIRTABLE_STUDENTS_PER_WRITE):
+                            _flush()
+            else:
+                _flush()
+        if last_write is not None:
+            last_write.result()  # re-raises the first failed write
+    finally:
+        writer.shutdown(wait=True)
 
-            summary_rows.append({
-                "Student Name": student_name,
-                "Term Name": term_name,
-                "Course Name": course_name,
-                "Total Assignments": total,
-                "Completed": completed,
-                "Unsubmitted": unsubmitted,
-                "Percentage Completed": pct,  # coerced to text if needed
-            })
-
-    p(f"[INFO] Built {len(detailed_rows)} detailed rows; {len(summary_rows)} summary rows.")
-    p(f"[INFO] Students in run: {len(students_data)} → {list(students_data.keys())[:5]}{'...' if len(students_data)>5 else ''}")
-
-    # ===== Schema check for select fields =====
-    p("[STEP] Fetching base schema…")
-    schema = _fetch_base_schema()
-    detailed_def = schema.get(AIRTABLE_DETAILED_TABLE_ID or AIRTABLE_DETAILED_TABLE)
-    summary_def  = schema.get(AIRTABLE_SUMMARY_TABLE_ID  or AIRTABLE_SUMMARY_TABLE)
-    if detailed_def:
-        _validate_or_coerce_selects(detailed_rows, detailed_def, "Detailed table")
-    if summary_def:
-        _validate_or_coerce_selects(summary_rows, summary_def, "Summary table")
-    p("[STEP] Schema check finished.")
-
-    # If "Percentage Completed" is single line text, format as "xx.xx%"
-    if summary_def:
-        _coerce_percentage_for_schema(summary_rows, summary_def, "Percentage Completed")
-
-    # Drop non-writable fields
-    if detailed_def:
-        detailed_rows = _filter_rows_to_writable(detailed_rows, detailed_def, "Detailed table")
-    if summary_def:
-        summary_rows  = _filter_rows_to_writable(summary_rows,  summary_def,  "Summary table")
-
-    # Write
-    p("[STEP] Writing detailed rows…")
-    airtable_insert_detailed(detailed_rows)
-    p("[STEP] Writing summary rows…")
-    airtable_insert_summary(summary_rows)
+    p(f"[INFO] Students in run: {len(students_written)} → {students_written[:5]}{'...' if len(students_written)>5 else ''}")
 
     p("\n=== Run Summary (All Terms) ===")
     p(f"Assignments processed: {stats['processed']}")